@@ -0,0 +1,18 @@
+"""Unpadded Base64URL (RFC 4648 §5) helpers shared by the WebAuthn and JWT code."""
+import base64
+import binascii
+from typing import Union
+
+# "+/" -> "-_" の変換表は import 時に一度だけ作る
+_STD_TO_URLSAFE = bytes.maketrans(b"+/", b"-_")
+
+
+def b64url_decode(s: Union[str, bytes]) -> bytes:
+    """Decodes Base64URL with or without padding, adding only the padding it needs."""
+    pad = -len(s) & 3
+    return base64.urlsafe_b64decode(s + (b"===" if isinstance(s, bytes) else "===")[:pad])
+
+
+def b64url_encode_nopad(b: bytes) -> str:
+    """Encodes bytes as unpadded Base64URL text."""
+    return binascii.b2a_base64(b, newline=False).translate(_STD_TO_URLSAFE).rstrip(b"=").decode("ascii")
@@ -1,18 +1,29 @@
+import asyncio
 import os
-from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, List, Any
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import timedelta
+from typing import Optional, Dict, List, Any, NamedTuple
 
 import jwt
+import orjson
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
+from fido2 import cbor
+from fido2.cose import CoseKey
 from fido2.server import Fido2Server
-from fido2.webauthn import PublicKeyCredentialRpEntity, AttestedCredentialData, AuthenticatorData, CollectedClientData, AttestationObject # Import AttestationObject from here
+from fido2.utils import websafe_encode
+from fido2.webauthn import PublicKeyCredentialRpEntity, AuthenticatorData, CollectedClientData, AttestationObject # Import AttestationObject from here
 # Remove AttestationObject import from fido2.ctap2 if it exists, or ensure it's not duplicated
 import base64
 
 from . import crud, models, schemas, database
+from ._b64 import b64url_decode
 
 # --- Environment Variables & Constants ---
 # .env ファイルから設定を読み込む
@@ -23,14 +34,37 @@ load_dotenv()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "default_secret_key") # .env から読み込む。デフォルト値は非推奨
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+_DEFAULT_TOKEN_TTL_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+# HMAC 鍵は毎回 encode しないよう bytes で保持しておく
+_SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8")
+# HS256 のヘッダーは固定なので import 時に一度だけエンコードしておく (PyJWT と同じ表現)
+_HS256_HEADER_B64 = base64.urlsafe_b64encode(orjson.dumps({"alg": "HS256", "typ": "JWT"})).rstrip(b'=')
+# 高速パスで扱うクレーム。これ以外を含むトークンは PyJWT に検証を任せる
+_FAST_PATH_CLAIMS = frozenset({"sub", "exp"})
+
+# get_current_user の結果をトークン単位でキャッシュする (JWT 検証と DB 参照を省略)
+# 保持する User はどのセッションにも属さない読み取り専用のスナップショットで、呼び出し元には
+# 渡さない。ヒット時は merge(load=False) でリクエストのセッションに載せたコピーを返すので、
+# リゾルバーでの変更は通常どおり commit され、他のリクエストには漏れない。
+# credentials もスナップショットなので、変更時は invalidate_user_cache() で破棄すること。
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_MAXSIZE = 4096
+_user_cache: "OrderedDict[bytes, tuple[float, models.User]]" = OrderedDict()
+# 無効化時に加算し、無効化前に始まった参照が古いユーザーを書き戻しても参照されないようにする
+_user_cache_generation = 0
 
 RP_ID = os.getenv("RP_ID", "localhost")
 RP_NAME = os.getenv("RP_NAME", "My FastAPI App")
 RP_ORIGIN = os.getenv("RP_ORIGIN", "http://localhost:3000") # フロントエンドのオリジン
 
-# Initialize Fido2Server using PublicKeyCredentialRpEntity instead of RelyingParty
-rp_entity = PublicKeyCredentialRpEntity(id=RP_ID, name=RP_NAME)
-fido2_server = Fido2Server(rp_entity)
+
+@lru_cache(maxsize=1)
+def get_fido2_server() -> Fido2Server:
+    """Returns the process-wide Fido2Server, building it on first use."""
+    # Initialize Fido2Server using PublicKeyCredentialRpEntity instead of RelyingParty
+    # テストで RP 設定を変える場合は get_fido2_server.cache_clear() で作り直す
+    return Fido2Server(PublicKeyCredentialRpEntity(id=RP_ID, name=RP_NAME))
 
 # OAuth2PasswordBearer はトークンを Authorization ヘッダーから Bearer トークンとして抽出します。
 # tokenUrl は実際のエンドポイントである必要はなく、ドキュメント生成のために使用されます。
@@ -39,26 +73,103 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token") # OpenAPI doc 用
 
 # --- JWT Functions ---
 
+def _hs256_sign(header_b64: bytes, payload_b64: bytes, key: bytes) -> bytes:
+    # hmac.digest は OpenSSL のワンショット実装 (SHA-NI 対応 CPU ではハードウェア支援) を使う
+    return hmac.digest(key, header_b64 + b'.' + payload_b64, 'sha256')
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    # exp は RFC 7519 の NumericDate (整数の epoch 秒) なので datetime を経由せずに計算する
+    to_encode["exp"] = int(time.time()) + (
+        int(expires_delta.total_seconds()) if expires_delta else _DEFAULT_TOKEN_TTL_SECONDS
+    )
+    if ALGORITHM != "HS256":
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+    # HS256 は PyJWT を経由せず、orjson + HMAC-SHA256 で直接組み立てる
+    payload_b64 = base64.urlsafe_b64encode(orjson.dumps(to_encode)).rstrip(b'=')
+    signature_b64 = base64.urlsafe_b64encode(
+        _hs256_sign(_HS256_HEADER_B64, payload_b64, _SECRET_KEY_BYTES)
+    ).rstrip(b'=')
+    return b'.'.join((_HS256_HEADER_B64, payload_b64, signature_b64)).decode('ascii')
+
+
+def _decode_token(token: str) -> Dict[str, Any]:
+    """Verifies an access token and returns its payload.
+
+    HS256 tokens minted by create_access_token are verified with a raw HMAC;
+    anything else (malformed tokens, other headers, extra claims or claim
+    types PyJWT would judge differently) goes through PyJWT. Raises
+    jwt.PyJWTError on failure either way.
+    """
+    if ALGORITHM == "HS256":
+        try:
+            header_b64, payload_b64, signature_b64 = token.encode('ascii').split(b'.')
+            signature = b64url_decode(signature_b64)
+        except ValueError:
+            pass # 不正な形式のトークンは PyJWT にエラーを報告させる
+        else:
+            if header_b64 == _HS256_HEADER_B64:
+                if not hmac.compare_digest(
+                    _hs256_sign(header_b64, payload_b64, _SECRET_KEY_BYTES), signature
+                ):
+                    raise jwt.InvalidSignatureError("Signature verification failed")
+                try:
+                    payload = orjson.loads(
+                        b64url_decode(payload_b64)
+                    )
+                except ValueError as e:
+                    raise jwt.DecodeError(f"Invalid payload: {e}") from e
+                # 型が想定通り (sub は str、exp は bool 以外の int) の場合だけ高速パスで判定し、
+                # それ以外は PyJWT のクレーム検証に任せる
+                exp = payload.get("exp") if isinstance(payload, dict) else None
+                if (
+                    isinstance(payload, dict)
+                    and payload.keys() <= _FAST_PATH_CLAIMS
+                    and isinstance(payload.get("sub"), str)
+                    and (exp is None or (isinstance(exp, int) and not isinstance(exp, bool)))
+                ):
+                    if exp is not None and exp <= time.time():
+                        raise jwt.ExpiredSignatureError("Signature has expired")
+                    return payload
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+def _user_cache_key(token: str, generation: int) -> bytes:
+    return hashlib.blake2b(
+        token.encode('utf-8'), digest_size=16, salt=generation.to_bytes(16, 'little')
+    ).digest()
+
+
+def invalidate_user_cache() -> None:
+    """Drops every cached user; call after a user's credentials change."""
+    global _user_cache_generation
+    _user_cache_generation += 1
+    _user_cache.clear()
+
 
 async def get_current_user(
     token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_db)
 ) -> models.User:
+    # キャッシュの参照・更新の間に await を挟まないので、ロックなしでも競合しない
+    cache_key = _user_cache_key(token, _user_cache_generation)
+    cached = _user_cache.get(cache_key)
+    if cached is not None:
+        expires_at, cached_user = cached
+        if time.monotonic() < expires_at:
+            _user_cache.move_to_end(cache_key)
+            # SELECT を発行せずにスナップショットの状態をこのセッションのインスタンスへ写す
+            return await db.merge(cached_user, load=False)
+        del _user_cache[cache_key]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _decode_token(token)
         username: str | None = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -69,7 +180,18 @@ async def get_current_user(
     user = await crud.get_user_by_username(db, username=token_data.username)
     if user is None:
         raise credentials_exception
-    return user
+
+    # セッションから切り離したものをキャッシュし、呼び出し元にはセッション上のコピーを返す
+    db.expunge(user)
+    ttl = USER_CACHE_TTL_SECONDS
+    exp = payload.get("exp")
+    if exp is not None:
+        # PyJWT 経由の場合は数値文字列なども通るが、int() で解釈できることは検証済み
+        ttl = min(ttl, int(exp) - time.time())
+    _user_cache[cache_key] = (time.monotonic() + ttl, user)
+    if len(_user_cache) > USER_CACHE_MAXSIZE:
+        _user_cache.popitem(last=False)
+    return await db.merge(user, load=False)
 
 async def get_current_active_user(
     current_user: models.User = Depends(get_current_user),
@@ -82,112 +204,99 @@ async def get_current_active_user(
 
 # --- Passkey (WebAuthn) Helper Functions ---
 
+def _verification_state(challenge: bytes) -> Dict[str, str]:
+    # register_begin / authenticate_begin が返す state と同じ形 (user_verification はどちらも "preferred")
+    return {"challenge": websafe_encode(challenge), "user_verification": "preferred"}
+
+
+class _StoredCredential(NamedTuple):
+    """The two attributes Fido2Server.authenticate_complete reads from a credential."""
+
+    credential_id: bytes
+    public_key: CoseKey
+
+
+@lru_cache(maxsize=4096)
+def load_public_key(public_key: bytes) -> CoseKey:
+    """Parses a stored credential public key (a CBOR-encoded COSE key)."""
+    # 同じ認証器で繰り返しログインする場合は CBOR の解析を省く (CoseKey は読み取り専用で使う)
+    return CoseKey.parse(cbor.decode(public_key))
+
+
 async def generate_registration_options(
     user: models.User, existing_credentials: List[models.Credential]
-) -> Dict[str, Any]:
+) -> schemas.RegistrationOptions:
     # 既存のクレデンシャルを除外リストに追加
     exclude_credentials = [{"type": "public-key", "id": cred.credential_id} for cred in existing_credentials]
 
-    options, state = fido2_server.register_begin(
+    options, state = get_fido2_server().register_begin(
         {
-            "id": user.id.to_bytes(8, 'big'), # user handle は bytes である必要がある
+            "id": user.user_handle, # ユーザー作成時に生成したランダムな user handle
             "name": user.username,
             "displayName": user.display_name,
         },
-        credentials=existing_credentials,
+        credentials=exclude_credentials, # fido2 v1.2.0 では credentials が excludeCredentials になる
         user_verification="preferred",
         authenticator_attachment="platform",
-        # exclude_credentials=exclude_credentials, # Remove unsupported argument for fido2 v1.2.0
     )
     # state はサーバー側で保持し、検証時に使用する必要がある
     # ここでは簡略化のため、セッションや一時ストレージに保存すると仮定
     # 例: await save_registration_state(user.id, state)
     # このサンプルでは state を直接返さず、別途管理することを前提とする
 
-    # PublicKeyCredentialCreationOptions をフロントエンドが期待する形式 (JSON シリアライズ可能) に変換
+    # PublicKeyCredentialCreationOptions をフロントエンドが期待する形式に変換
     # options は CredentialCreationOptions 型で、実際のデータは public_key 属性にある
+    # bytes 型の値はそのまま残し、レスポンスの JSON エンコード時に一度だけ Base64URL に変換する
     public_key_options = options.public_key
-    options_json_serializable = {
-        "rp": {
-            "id": public_key_options.rp.id,
-            "name": public_key_options.rp.name,
-        },
-        "user": {
-            "id": base64.urlsafe_b64encode(public_key_options.user.id).rstrip(b'=').decode('utf-8'),
-            "name": public_key_options.user.name,
-            "displayName": public_key_options.user.display_name,
-        },
-        "challenge": base64.urlsafe_b64encode(public_key_options.challenge).rstrip(b'=').decode('utf-8'),
-        "pubKeyCredParams": [
-            {"type": param.type, "alg": param.alg} for param in public_key_options.pub_key_cred_params
-        ],
-        # オプショナルな属性も必要に応じて追加
-        "timeout": public_key_options.timeout,
-        "excludeCredentials": [
-            {"type": cred.type, "id": base64.urlsafe_b64encode(cred.id).rstrip(b'=').decode('utf-8'), "transports": cred.transports}
-            for cred in public_key_options.exclude_credentials
-        ] if public_key_options.exclude_credentials else [],
-        "authenticatorSelection": {
-            "authenticatorAttachment": public_key_options.authenticator_selection.authenticator_attachment,
-            "residentKey": public_key_options.authenticator_selection.resident_key,
-            "userVerification": public_key_options.authenticator_selection.user_verification,
-            "requireResidentKey": public_key_options.authenticator_selection.require_resident_key,
-        } if public_key_options.authenticator_selection else None,
-        "attestation": public_key_options.attestation,
-        "extensions": public_key_options.extensions,
-    }
-
-    # bytes 型を Base64URL 文字列に変換 (上記で実施済み)
-    # options_json_serializable["challenge"] = base64.urlsafe_b64encode(public_key_options.challenge).rstrip(b'=').decode('utf-8')
-    # options_json_serializable["user"]["id"] = base64.urlsafe_b64encode(public_key_options.user.id).rstrip(b'=').decode('utf-8')
-    # if "excludeCredentials" in options_json_serializable and options_json_serializable["excludeCredentials"]:
-    #     for cred in options_json_serializable["excludeCredentials"]:
-    #         cred["id"] = base64.urlsafe_b64encode(cred["id"]).rstrip(b'=').decode('utf-8')
-    # 他に bytes 型があれば同様に変換
-
-    # FastAPI/Strawberry が扱えるように、変換後の辞書を返す
-    return options_json_serializable
+    selection = public_key_options.authenticator_selection
+    return schemas.RegistrationOptions(
+        rp=schemas.RpEntityOptions(id=public_key_options.rp.id, name=public_key_options.rp.name),
+        user=schemas.UserEntityOptions(
+            id=public_key_options.user.id,
+            name=public_key_options.user.name,
+            display_name=public_key_options.user.display_name,
+        ),
+        challenge=public_key_options.challenge,
+        # fido2 のデータオブジェクト (dataclass) は JSON エンコード時にそのまま dict として書き出される
+        pub_key_cred_params=public_key_options.pub_key_cred_params,
+        timeout=public_key_options.timeout,
+        exclude_credentials=public_key_options.exclude_credentials or [],
+        authenticator_selection=schemas.AuthenticatorSelectionOptions(
+            authenticator_attachment=selection.authenticator_attachment,
+            resident_key=selection.resident_key,
+            user_verification=selection.user_verification,
+            require_resident_key=selection.require_resident_key,
+        ) if selection else None,
+        attestation=public_key_options.attestation,
+        extensions=public_key_options.extensions,
+    )
 
 
 async def verify_registration(
     user: models.User,
     registration_response: schemas.RegistrationResponseJSON,
-    expected_challenge_b64: str, # セッション等から取得したチャレンジ (Base64URL)
+    expected_challenge: bytes, # チャレンジストアから取得したチャレンジ (生の bytes)
     expected_origin: str = RP_ORIGIN,
     expected_rp_id: str = RP_ID,
     require_user_verification: bool = True,
-) -> AttestedCredentialData:
-
-    # state を取得 (セッションや一時ストレージから)
-    # 例: state = await get_registration_state(user.id)
-    # このサンプルでは state を検証に使わない fido2 ライブラリの機能を利用
-    # (state の検証は fido2.webauthn.verify_registration_response で行うのがより堅牢)
+) -> AuthenticatorData:
 
-    challenge_bytes = base64.urlsafe_b64decode(expected_challenge_b64 + '==')
+    # チャレンジはチャレンジストアに保存したものを使い、fido2 の state の形にして照合させる
 
     try:
-        auth_data = fido2_server.register_complete(
-             state={}, # 本来は register_begin で得た state を使うべき
-             client_data=CollectedClientData(registration_response.response["clientDataJSON"]),
-             attestation_object=AttestationObject(base64.urlsafe_b64decode(registration_response.response["attestationObject"] + '==')),
+        # CBOR/COSE の解析と署名検証は CPU を使う同期処理なので、イベントループを塞がないようスレッドで実行する
+        auth_data = await asyncio.to_thread(
+             get_fido2_server().register_complete,
+             state=_verification_state(expected_challenge),
+             client_data=CollectedClientData(b64url_decode(registration_response.response.client_data_json)),
+             attestation_object=AttestationObject(b64url_decode(registration_response.response.attestation_object)),
              # expected_origin=expected_origin, # origin の検証 (fido2 ライブラリが内部で行うはず)
              # expected_rp_id=expected_rp_id, # rpId の検証 (fido2 ライブラリが内部で行うはず)
-             # expected_challenge=challenge_bytes # challenge の検証 (fido2 ライブラリが内部で行うはず)
+             # expected_challenge=expected_challenge # challenge の検証 (fido2 ライブラリが内部で行うはず)
              # require_user_verification=require_user_verification # UV の検証
         )
-        # 注意: fido2 ライブラリの register_complete は state を必須引数としていない場合があるが、
-        # セキュリティのため、本来は register_begin で生成された state (challenge を含む) を
-        # 検証時に照合すべき。ここでは簡略化のため省略している。
-        # より堅牢な実装では、fido2.webauthn.verify_registration_response を直接使うことを検討。
-        # verify_registration_response(
-        #     credential=registration_response.dict(by_alias=True), # Pydantic モデルを辞書に
-        #     expected_challenge=challenge_bytes,
-        #     expected_origin=expected_origin,
-        #     expected_rp_id=expected_rp_id,
-        #     require_user_verification=require_user_verification,
-        # )
-
-        # 検証成功、認証情報データを返す
+
+        # 検証成功、認証器データ (credential_data に公開鍵を含む) を返す
         return auth_data
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Registration verification failed: {e}")
@@ -200,23 +309,22 @@ async def generate_authentication_options(
     username: Optional[str] = None,
     user_handle_b64: Optional[str] = None,
     db: AsyncSession = Depends(database.get_db)
-) -> Dict[str, Any]:
+) -> schemas.AuthenticationOptions:
 
     allow_credentials = []
     if username:
-        user = await crud.get_user_by_username(db, username=username)
+        user = await crud.get_user_by_username(db, username=username, with_credentials=True)
         if user:
-            credentials = await crud.get_credentials_by_user(db, user.id)
+            # credentials は selectinload 済みなので追加の SELECT は不要
+            credentials = user.credentials
             allow_credentials = [{"type": "public-key", "id": cred.credential_id} for cred in credentials]
     elif user_handle_b64:
          # Discoverable Credentials (Resident Keys) の場合、username なしで user_handle から探す
-         # user_handle は register_begin で指定した user.id の bytes 表現
+         # user_handle は register_begin で user.id として渡した User.user_handle
          try:
-             user_id_bytes = base64.urlsafe_b64decode(user_handle_b64 + '==')
-             user_id = int.from_bytes(user_id_bytes, 'big')
-             user = await crud.get_user(db, user_id=user_id)
+             user = await crud.get_user_by_handle(db, user_handle=b64url_decode(user_handle_b64))
              if user:
-                 credentials = await crud.get_credentials_by_user(db, user.id)
+                 credentials = user.credentials
                  allow_credentials = [{"type": "public-key", "id": cred.credential_id} for cred in credentials]
          except (ValueError, TypeError):
              pass # 不正な user_handle は無視
@@ -228,7 +336,7 @@ async def generate_authentication_options(
          raise HTTPException(status_code=404, detail=f"No credentials found for user '{username}'")
 
 
-    options, state = fido2_server.authenticate_begin(
+    options, state = get_fido2_server().authenticate_begin(
         credentials=allow_credentials, # ユーザーに紐づくクレデンシャル ID のリスト
         user_verification="preferred"
     )
@@ -236,58 +344,64 @@ async def generate_authentication_options(
     # state (challenge を含む) を保存
     # 例: await save_authentication_state(username or user_handle_b64, state) # キーを一意にする
 
-    # フロントエンド向けに変換
-    options_json_serializable = dict(options)
-    options_json_serializable["challenge"] = base64.urlsafe_b64encode(options_json_serializable["challenge"]).rstrip(b'=').decode('utf-8')
-    if "allowCredentials" in options_json_serializable:
-        for cred in options_json_serializable["allowCredentials"]:
-            cred["id"] = base64.urlsafe_b64encode(cred["id"]).rstrip(b'=').decode('utf-8')
-
-    return options_json_serializable
+    # フロントエンド向けに変換 (bytes 型の値はレスポンスの JSON エンコード時に Base64URL へ変換される)
+    # options は CredentialRequestOptions 型で、実際のデータは public_key 属性にある
+    public_key_options = options.public_key
+    return schemas.AuthenticationOptions(
+        challenge=public_key_options.challenge,
+        timeout=public_key_options.timeout,
+        rp_id=public_key_options.rp_id,
+        allow_credentials=public_key_options.allow_credentials or [],
+        user_verification=public_key_options.user_verification,
+        extensions=public_key_options.extensions,
+    )
 
 async def verify_authentication(
     credential_id_b64: str, # フロントエンドから送られてきた Credential ID (Base64URL)
     auth_response: schemas.AuthenticationResponseJSON,
-    expected_challenge_b64: str, # セッション等から取得したチャレンジ (Base64URL)
+    expected_challenge: bytes, # チャレンジストアから取得したチャレンジ (生の bytes)
     db: AsyncSession,
     expected_origin: str = RP_ORIGIN,
     expected_rp_id: str = RP_ID,
     require_user_verification: bool = True,
 ) -> models.Credential:
 
-    credential = await crud.get_credential_by_id(db, credential_id_b64=credential_id_b64)
+    # Credential ID はここで一度だけデコードし、以降は bytes のまま扱う
+    try:
+        credential_id = b64url_decode(credential_id_b64)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid credential ID encoding")
+    credential = await crud.get_credential_by_id(db, credential_id=credential_id)
     if not credential:
         raise HTTPException(status_code=404, detail="Credential not found")
 
-    # state を取得 (セッション等から)
-    # 例: state = await get_authentication_state(credential.user.username) # または他のキー
-
-    challenge_bytes = base64.urlsafe_b64decode(expected_challenge_b64 + '==')
-
     try:
         # AuthenticatorData と ClientData をデコード
-        auth_data_bytes = base64.urlsafe_b64decode(auth_response.response["authenticatorData"] + '==')
-        client_data = CollectedClientData(auth_response.response["clientDataJSON"])
-        signature_bytes = base64.urlsafe_b64decode(auth_response.response["signature"] + '==')
+        auth_data = AuthenticatorData(b64url_decode(auth_response.response.authenticator_data))
+        client_data = CollectedClientData(b64url_decode(auth_response.response.client_data_json))
+        signature_bytes = b64url_decode(auth_response.response.signature)
 
         # fido2 ライブラリの authenticate_complete を使用して検証
         # この関数は内部で challenge, origin, rpId, user verification, signature の検証を行う
-        fido2_server.authenticate_complete(
-            state={}, # 本来は authenticate_begin で得た state を使う
-            credentials=[credential], # DB から取得した認証情報
+        # 署名検証は CPU を使う同期処理なので、イベントループを塞がないようスレッドで実行する
+        await asyncio.to_thread(
+            get_fido2_server().authenticate_complete,
+            state=_verification_state(expected_challenge),
+            # DB の公開鍵 (CBOR の COSE 鍵) は解析済みのものをキャッシュから使う
+            credentials=[_StoredCredential(credential.credential_id, load_public_key(credential.public_key))],
             credential_id=credential.credential_id,
             client_data=client_data,
-            auth_data=AuthenticatorData(auth_data_bytes),
+            auth_data=auth_data,
             signature=signature_bytes,
             # expected_origin=expected_origin, # fido2 が内部で検証
             # expected_rp_id=expected_rp_id, # fido2 が内部で検証
-            # expected_challenge=challenge_bytes, # fido2 が内部で検証
+            # expected_challenge=expected_challenge, # fido2 が内部で検証
             # require_user_verification=require_user_verification # fido2 が内部で検証
         )
 
-        # 署名カウンターの検証と更新
-        new_sign_count = AuthenticatorData(auth_data_bytes).sign_count
-        if new_sign_count <= credential.sign_count:
+        # 署名カウンターの検証と更新 (カウンターを持たない認証器は常に 0 を返すので、その場合は比較しない)
+        new_sign_count = auth_data.counter
+        if (new_sign_count or credential.sign_count) and new_sign_count <= credential.sign_count:
              # リプレイ攻撃の可能性
              raise HTTPException(status_code=400, detail="Authenticator counter mismatch. Possible replay attack.")
 
@@ -296,6 +410,8 @@ async def verify_authentication(
 
         return credential
 
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Authentication verification failed: {e}")
     except Exception as e:
@@ -303,23 +419,78 @@ async def verify_authentication(
         raise HTTPException(status_code=500, detail=f"Internal server error during authentication: {e}")
 
 
-# --- Temporary State Storage (Replace with proper session/cache) ---
-# !!! WARNING: This is a very basic in-memory store for demonstration ONLY. !!!
-# !!! DO NOT use this in production. Use Redis, a database, or server-side sessions. !!!
-temp_challenge_store: Dict[str, str] = {}
-
-async def save_challenge(key: str, challenge: str):
-    # NOTE: In a real app, use a secure session mechanism or a timed cache (e.g., Redis)
-    # Ensure the key is unique per user/session and the challenge expires.
-    print(f"Saving challenge for {key}: {challenge}") # Debug print
-    temp_challenge_store[key] = challenge
-
-async def get_challenge(key: str) -> Optional[str]:
+# --- Challenge Storage ---
+# REDIS_URL が設定されていれば Redis に保存し、ワーカー間で共有する (`pip install .[redis]`)。
+# 未設定の場合は単一プロセスの開発用に、プロセス内の TTL 付き辞書を使う。
+# チャレンジは生の bytes のまま保存し、Base64URL への変換はレスポンスの JSON エンコード時の一度だけにする。
+CHALLENGE_TTL_SECONDS = 300
+REDIS_URL = os.getenv("REDIS_URL")
+# チャレンジキーの導出に使う鍵 (ワーカー間で同じ値である必要がある)。
+# 未設定の場合は JWT の秘密鍵から導出する (blake2b の鍵は 64 バイトまでなのでハッシュして長さを揃える)
+_CHALLENGE_KEY_SECRET = hashlib.blake2b(
+    os.getenv("CHALLENGE_KEY_SECRET", SECRET_KEY).encode("utf-8"), digest_size=32, person=b"challenge-key"
+).digest()
+
+
+class _MemoryChallengeStore:
+    """In-process fallback with the same set-with-TTL / get-and-delete semantics as Redis."""
+
+    def __init__(self, ttl: int, maxsize: int = 10_000):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._data: Dict[str, tuple[float, bytes]] = {}
+
+    async def set(self, key: str, value: bytes) -> None:
+        now = time.monotonic()
+        # TTL は一定なので、挿入順 (dict の順序) がそのまま期限切れの順になる。
+        # 同じキーの上書きは末尾へ移し、取り出されずに残った期限切れのチャレンジを先頭から捨てる
+        self._data.pop(key, None)
+        data = self._data
+        while data:
+            oldest_key = next(iter(data))
+            if data[oldest_key][0] > now and len(data) < self._maxsize:
+                break
+            del data[oldest_key]
+        data[key] = (now + self._ttl, value)
+
+    async def getdel(self, key: str) -> Optional[bytes]:
+        entry = self._data.pop(key, None)
+        if entry is None or time.monotonic() >= entry[0]:
+            return None
+        return entry[1]
+
+
+class _RedisChallengeStore:
+    def __init__(self, url: str, ttl: int):
+        import redis.asyncio as redis_asyncio
+
+        self._ttl = ttl
+        self._redis = redis_asyncio.Redis.from_url(url)
+
+    async def set(self, key: str, value: bytes) -> None:
+        await self._redis.set(key, value, ex=self._ttl)
+
+    async def getdel(self, key: str) -> Optional[bytes]:
+        # GETDEL (Redis 6.2+) で取得と削除を 1 往復で行う
+        return await self._redis.getdel(key)
+
+
+challenge_store = (
+    _RedisChallengeStore(REDIS_URL, CHALLENGE_TTL_SECONDS) if REDIS_URL
+    else _MemoryChallengeStore(CHALLENGE_TTL_SECONDS)
+)
+
+async def save_challenge(key: str, challenge: bytes):
+    # 同じキーで再度オプションを要求された場合は、新しいチャレンジで上書きする
+    await challenge_store.set(key, challenge)
+
+async def get_challenge(key: str) -> Optional[bytes]:
     # NOTE: Retrieve and immediately clear the challenge to prevent reuse.
-    print(f"Getting challenge for {key}") # Debug print
-    return temp_challenge_store.pop(key, None)
+    return await challenge_store.getdel(key)
 
 def generate_challenge_key(username: str, type: str = "reg") -> str:
     """Generates a unique key for storing challenges."""
-    # Simple example, consider using session ID or user ID for better scoping
-    return f"{username}_{type}_challenge"
+    # 鍵付き blake2b でユーザー名をストアやクライアントに出さない、固定長 (32 文字) のキーにする
+    return hashlib.blake2b(
+        f"{username}|{type}".encode("utf-8"), digest_size=16, key=_CHALLENGE_KEY_SECRET
+    ).hexdigest()
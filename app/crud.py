@@ -1,9 +1,32 @@
+from sqlalchemy import LargeBinary, bindparam, delete, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from . import models, schemas
+from ._b64 import b64url_decode
 from typing import List, Optional
-import base64
+import secrets
+
+
+# 認証のたびに実行されるクエリは import 時に一度だけ組み立て、値はバインドパラメータで渡す
+# credentials は使う呼び出し元 (with_credentials=True) だけが selectinload する。
+# それ以外で参照すると User.credentials の lazy="raise" により例外になる
+_STMT_USER_BY_ID = select(models.User).where(models.User.id == bindparam("user_id"))
+_STMT_USER_BY_ID_WITH_CREDENTIALS = _STMT_USER_BY_ID.options(selectinload(models.User.credentials))
+_STMT_USER_BY_NAME = select(models.User).where(models.User.username == bindparam("username"))
+_STMT_USER_BY_NAME_WITH_CREDENTIALS = _STMT_USER_BY_NAME.options(selectinload(models.User.credentials))
+_STMT_USER_BY_HANDLE = (
+    select(models.User)
+    .where(models.User.user_handle == bindparam("user_handle", type_=LargeBinary))
+    .options(selectinload(models.User.credentials)) # Eager load credentials
+)
+_STMT_CREDS_BY_USER = select(models.Credential).where(models.Credential.user_id == bindparam("user_id"))
+_STMT_CRED_BY_ID = (
+    select(models.Credential)
+    .where(models.Credential.credential_id == bindparam("credential_id", type_=LargeBinary))
+    .options(selectinload(models.Credential.user)) # Eager load user
+)
 
 
 # --- Item CRUD ---
@@ -19,7 +42,8 @@ async def get_items(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[m
 
 
 async def create_item(db: AsyncSession, item: schemas.ItemCreate) -> models.Item:
-    db_item = models.Item(**item.model_dump())
+    # 検証済みのフィールド値は __dict__ にあるので、model_dump で dict を作り直さずに渡す
+    db_item = models.Item(**item.__dict__)
     db.add(db_item)
     await db.commit()
     await db.refresh(db_item)
@@ -27,44 +51,58 @@ async def create_item(db: AsyncSession, item: schemas.ItemCreate) -> models.Item
 
 
 async def delete_item(db: AsyncSession, item_id: int) -> bool:
-    db_item = await get_item(db, item_id)
-    if db_item:
-        await db.delete(db_item)
-        await db.commit()
-        return True
-    return False
+    # SELECT してから削除せず、DELETE 1 文で済ませる
+    result = await db.execute(delete(models.Item).where(models.Item.id == item_id))
+    await db.commit()
+    return result.rowcount > 0
 
 
 async def update_item(db: AsyncSession, item_id: int, item_update: schemas.ItemCreate) -> Optional[models.Item]:
-    db_item = await get_item(db, item_id)
-    if db_item:
-        update_data = item_update.model_dump(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_item, key, value)
-        await db.commit()
-        await db.refresh(db_item)
-        return db_item
-    return None
+    # 明示的に指定されたフィールドだけを更新する (model_dump(exclude_unset=True) と同じ)
+    update_data = {name: getattr(item_update, name) for name in item_update.model_fields_set}
+    if not update_data:
+        return await get_item(db, item_id)
+    # UPDATE ... RETURNING で更新後の行をそのまま受け取り、refresh の SELECT を省く
+    result = await db.execute(
+        update(models.Item)
+        .where(models.Item.id == item_id)
+        .values(**update_data)
+        .returning(models.Item)
+        # 同じセッションで読み込み済みのインスタンスも RETURNING の値で上書きする
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    db_item = result.scalars().first()
+    await db.commit()
+    return db_item
 
 
 # --- User CRUD ---
 
-async def get_user(db: AsyncSession, user_id: int) -> Optional[models.User]:
-    result = await db.execute(select(models.User).where(models.User.id == user_id))
+async def get_user(db: AsyncSession, user_id: int, with_credentials: bool = False) -> Optional[models.User]:
+    stmt = _STMT_USER_BY_ID_WITH_CREDENTIALS if with_credentials else _STMT_USER_BY_ID
+    result = await db.execute(stmt, {"user_id": user_id})
     return result.scalars().first()
 
 
-async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
-    result = await db.execute(
-        select(models.User)
-        .where(models.User.username == username)
-        .options(selectinload(models.User.credentials)) # Eager load credentials
-    )
+async def get_user_by_username(
+    db: AsyncSession, username: str, with_credentials: bool = False
+) -> Optional[models.User]:
+    stmt = _STMT_USER_BY_NAME_WITH_CREDENTIALS if with_credentials else _STMT_USER_BY_NAME
+    result = await db.execute(stmt, {"username": username})
+    return result.scalars().first()
+
+
+async def get_user_by_handle(db: AsyncSession, user_handle: bytes) -> Optional[models.User]:
+    result = await db.execute(_STMT_USER_BY_HANDLE, {"user_handle": user_handle})
     return result.scalars().first()
 
 
 async def create_user(db: AsyncSession, user: schemas.UserCreate) -> models.User:
-    db_user = models.User(username=user.username, display_name=user.display_name)
+    db_user = models.User(
+        username=user.username,
+        display_name=user.display_name,
+        user_handle=secrets.token_bytes(models.USER_HANDLE_BYTES),
+    )
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
@@ -81,8 +119,8 @@ async def add_credential_to_user(
     sign_count: int,
     transports: Optional[List[str]] = None
 ) -> models.Credential:
-    credential_id_bytes = base64.urlsafe_b64decode(credential_id_b64 + '==')
-    public_key_bytes = base64.urlsafe_b64decode(public_key_b64 + '==')
+    credential_id_bytes = b64url_decode(credential_id_b64)
+    public_key_bytes = b64url_decode(public_key_b64)
 
     db_credential = models.Credential(
         user_id=user.id,
@@ -97,22 +135,22 @@ async def add_credential_to_user(
     return db_credential
 
 async def get_credentials_by_user(db: AsyncSession, user_id: int) -> List[models.Credential]:
-    result = await db.execute(
-        select(models.Credential).where(models.Credential.user_id == user_id)
-    )
+    result = await db.execute(_STMT_CREDS_BY_USER, {"user_id": user_id})
     return result.scalars().all()
 
-async def get_credential_by_id(db: AsyncSession, credential_id_b64: schemas.Base64UrlStr) -> Optional[models.Credential]:
-    credential_id_bytes = base64.urlsafe_b64decode(credential_id_b64 + '==')
-    result = await db.execute(
-        select(models.Credential)
-        .where(models.Credential.credential_id == credential_id_bytes)
-        .options(selectinload(models.Credential.user)) # Eager load user
-    )
+async def get_credential_by_id(db: AsyncSession, credential_id: bytes) -> Optional[models.Credential]:
+    result = await db.execute(_STMT_CRED_BY_ID, {"credential_id": credential_id})
     return result.scalars().first()
 
 async def update_credential_sign_count(db: AsyncSession, credential: models.Credential, new_sign_count: int) -> models.Credential:
-    credential.sign_count = new_sign_count
+    # 値は分かっているので UPDATE 1 文で更新し、refresh の SELECT は行わない
+    await db.execute(
+        update(models.Credential)
+        .where(models.Credential.id == credential.id)
+        .values(sign_count=new_sign_count)
+        .execution_options(synchronize_session=False)
+    )
     await db.commit()
-    await db.refresh(credential)
+    # 読み込み済みのインスタンスにも反映する (変更扱いにはしない)
+    set_committed_value(credential, "sign_count", new_sign_count)
     return credential
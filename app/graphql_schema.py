@@ -1,42 +1,55 @@
 import strawberry
-from strawberry.exceptions import StrawberryException # Import from strawberry.exceptions
+from strawberry.extensions import ParserCache, ValidationCache
 from strawberry.fastapi import BaseContext, GraphQLRouter
 from strawberry.types import Info as _Info
+from collections.abc import Mapping
 from typing import List, Optional, AsyncGenerator, Dict, Any
 from fastapi import Depends, HTTPException, Request, Response
+from fido2 import cbor
+from graphql import ExecutionContext, GraphQLError
+from graphql.pyutils import is_awaitable as default_is_awaitable
 from sqlalchemy.ext.asyncio import AsyncSession
-import base64 # base64 を追加
-import json # JSON スカラー用
+import asyncio
+import msgspec
+import orjson
 
 from . import crud, models, schemas, auth # auth をインポート
+from ._b64 import b64url_encode_nopad
 from .database import get_db
 
 
+# エラーコード。クライアントはメッセージの文字列ではなく extensions.code で分岐できる
+USER_NOT_FOUND = "USER_NOT_FOUND"
+USERNAME_TAKEN = "USERNAME_TAKEN"
+CHALLENGE_EXPIRED = "CHALLENGE_EXPIRED"
+INVALID_INPUT = "INVALID_INPUT"
+INVALID_FORMAT = "INVALID_FORMAT"
+VERIFICATION_FAILED = "VERIFICATION_FAILED"
+INTERNAL_ERROR = "INTERNAL_ERROR"
+
+
+def _error(code: str, message: str) -> GraphQLError:
+    # code はレスポンスの errors[].extensions.code として返る
+    return GraphQLError(message, extensions={"code": code})
+
+
 # JSON スカラータイプを定義 (Strawberry はデフォルトで JSON をサポートしないため)
 JSON = strawberry.scalar(
     Any, serialize=lambda v: v, parse_value=lambda v: v, description="Generic JSON scalar"
 )
 
 
-async def get_current_user_from_token(
-    request: Request,
-    db: AsyncSession = Depends(get_db)
-) -> Optional[models.User]:
-    """
-    Extracts user from Authorization header token (if present).
-    Returns None if no token or invalid token. Does not raise Exception.
-    """
-    auth_header = request.headers.get("Authorization")
-    if auth_header:
-        parts = auth_header.split()
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            token = parts[1]
-            try:
-                # Use a modified version or wrapper around get_current_user that doesn't raise HTTPException
-                # For simplicity here, we'll call it directly and catch the exception.
-                return await auth.get_current_user(token=token, db=db)
-            except HTTPException:
-                return None # Invalid token treated as no user
+def get_bearer_token(request: Request) -> Optional[str]:
+    """Returns the bearer token from the Authorization header, or None."""
+    # Headers オブジェクトを作らず、ASGI scope の生ヘッダー (名前は小文字の bytes) を直接調べる
+    for name, value in request.scope["headers"]:
+        if name == b"authorization":
+            if value[:7].lower() == b"bearer ":
+                token = value[7:].strip()
+                # "Bearer a b" のように空白を含む値はトークンとして扱わない
+                if token and b" " not in token:
+                    return token.decode("latin-1")
+            return None
     return None
 
 
@@ -44,16 +57,36 @@ class ContextData(BaseContext):
     db: AsyncSession
     request: Request
     response: Response
-    current_user: Optional[models.User]
 
-    def __init__(self, db: AsyncSession, request: Request, response: Response, current_user: Optional[models.User]):
+    def __init__(self, db: AsyncSession, request: Request, response: Response, token: Optional[str] = None):
         # BaseContext doesn't take request/response in __init__
         super().__init__()
         self.db = db
         # Store request and response directly on the context if needed elsewhere
         self.request = request
         self.response = response
-        self.current_user = current_user
+        self._token = token
+        self._current_user_task: Optional[asyncio.Task] = None
+
+    async def get_current_user(self) -> Optional[models.User]:
+        """Resolves the user for the request's bearer token on first use.
+
+        Returns None if there is no token or it is invalid. Does not raise.
+        """
+        # 認証が必要なフィールドを含まないリクエストでは JWT の検証も SELECT も行わない。
+        # 同じリクエストの複数のリゾルバーから並行して呼ばれてもセッションを同時に使わないよう、
+        # 最初の呼び出しで作ったタスクを共有する
+        if self._current_user_task is None:
+            self._current_user_task = asyncio.ensure_future(self._load_current_user())
+        return await self._current_user_task
+
+    async def _load_current_user(self) -> Optional[models.User]:
+        if self._token is None:
+            return None
+        try:
+            return await auth.get_current_user(token=self._token, db=self.db)
+        except HTTPException:
+            return None # Invalid token treated as no user
 
 # Update type hint for Info
 Context = _Info[ContextData, None]
@@ -63,33 +96,44 @@ async def get_graphql_context(
     request: Request,
     response: Response,
     db: AsyncSession = Depends(get_db),
-    current_user: Optional[models.User] = Depends(get_current_user_from_token) # トークンからユーザー取得
 ) -> ContextData:
-    return ContextData(db=db, request=request, response=response, current_user=current_user)
+    return ContextData(db=db, request=request, response=response, token=get_bearer_token(request))
 
 
 # --- Strawberry Types ---
 
-@strawberry.experimental.pydantic.type(model=schemas.UserRead, all_fields=True)
+# 出力型は Pydantic を経由しない素の Strawberry 型にして、リゾルバーは ORM オブジェクトを
+# そのまま返す (Strawberry は属性を名前で読むので、行ごとの変換や検証が発生しない)
+@strawberry.type
 class UserType:
-    pass
+    id: int
+    username: str
+    display_name: str
 
-@strawberry.experimental.pydantic.type(model=schemas.Token, all_fields=True)
+@strawberry.type
 class TokenType:
-    pass
+    access_token: str
+    token_type: str = "bearer"
 
-@strawberry.experimental.pydantic.type(model=schemas.ItemRead, all_fields=True)
+@strawberry.type
 class ItemType:
-  pass
+    id: int
+    name: str
+    description: Optional[str]
+    price: float
 
 
-@strawberry.experimental.pydantic.input(model=schemas.UserCreate, all_fields=True)
+# 入力型も素の Strawberry 型にする。長さなどの制約は必要な箇所で Pydantic のスキーマを使って検証する
+@strawberry.input
 class UserInput:
-    pass
+    username: str
+    display_name: str
 
-@strawberry.experimental.pydantic.input(model=schemas.ItemCreate, all_fields=True)
+@strawberry.input
 class ItemInput:
-  pass
+    name: str
+    description: Optional[str] = None
+    price: float
 
 # Input type for Passkey registration verification
 @strawberry.input
@@ -110,11 +154,8 @@ class AuthenticationVerificationInput:
 class IsAuthenticated(strawberry.permission.BasePermission):
     message = "User is not authenticated."
 
-    # This method can also be async!
-    def has_permission(self, source: Any, info: Context, **kwargs) -> bool:
-        if info.context.current_user:
-            return True
-        return False
+    async def has_permission(self, source: Any, info: Context, **kwargs) -> bool:
+        return await info.context.get_current_user() is not None
 
 
 
@@ -124,8 +165,8 @@ class IsAuthenticated(strawberry.permission.BasePermission):
 class Query:
     @strawberry.field(permission_classes=[IsAuthenticated]) # 保護されたクエリ
     async def me(self, info: Context) -> UserType:
-        # IsAuthenticated でチェック済みなので current_user は存在するはず
-        return UserType.from_pydantic(info.context.current_user)
+        # IsAuthenticated でチェック済みなので current_user は存在するはず (2 回目以降は解決済みの値を返す)
+        return await info.context.get_current_user()
 
     @strawberry.field
     async def generate_registration_options(
@@ -139,18 +180,18 @@ class Query:
             try:
                 user_create = schemas.UserCreate(username=username, display_name=display_name)
             except ValueError as e:
-                raise StrawberryException(f"Invalid user data: {e}")
+                raise _error(INVALID_INPUT, f"Invalid user data: {e}")
             user = await crud.create_user(db, user=user_create)
         elif user.display_name != display_name:
             # 既存ユーザーだが表示名が異なる場合はエラーにするか更新するか要検討
-             raise StrawberryException(f"Username '{username}' already exists with a different display name.")
+             raise _error(USERNAME_TAKEN, f"Username '{username}' already exists with a different display name.")
 
         existing_credentials = await crud.get_credentials_by_user(db, user.id)
         options = await auth.generate_registration_options(user, existing_credentials)
 
         # チャレンジを保存 (キーにはユーザー名と 'reg' タイプを使用)
         challenge_key = auth.generate_challenge_key(username, "reg")
-        await auth.save_challenge(challenge_key, options["challenge"])
+        await auth.save_challenge(challenge_key, options.challenge)
 
         # フロントエンドが使いやすいようにキー情報も返す
         return {"options": options, "challengeKey": challenge_key}
@@ -166,11 +207,11 @@ class Query:
             options = await auth.generate_authentication_options(username=username, db=db)
         except HTTPException as e:
              # ユーザーが見つからない場合など
-             raise StrawberryException(e.detail)
+             raise _error(USER_NOT_FOUND if e.status_code == 404 else INVALID_INPUT, e.detail)
 
         # チャレンジを保存 (キーにはユーザー名または 'auth' タイプを使用)
         challenge_key = auth.generate_challenge_key(username or "discoverable", "auth")
-        await auth.save_challenge(challenge_key, options["challenge"])
+        await auth.save_challenge(challenge_key, options.challenge)
 
         return {"options": options, "challengeKey": challenge_key}
 
@@ -180,7 +221,7 @@ class Query:
     async def items(self, info: Context, skip: int = 0, limit: int = 10) -> List[ItemType]:
         db = info.context.db
         items_db = await crud.get_items(db=db, skip=skip, limit=limit)
-        return [ItemType.from_pydantic(item) for item in items_db]
+        return items_db
 
     @strawberry.field(permission_classes=[IsAuthenticated])
     async def item(self, info: Context, item_id: int) -> Optional[ItemType]:
@@ -188,7 +229,7 @@ class Query:
         item_db = await crud.get_item(db=db, item_id=item_id)
         if item_db is None:
             return None
-        return ItemType.from_pydantic(item_db)
+        return item_db
 
 
 # --- Mutation ---
@@ -197,11 +238,16 @@ class Mutation:
     @strawberry.mutation
     async def register_user(self, info: Context, user_input: UserInput) -> UserType:
         db = info.context.db
-        existing_user = await crud.get_user_by_username(db, username=user_input.username)
+        # Pydantic モデルを使ってバリデーション (ユーザー名・表示名の長さ)
+        try:
+            user_create = schemas.UserCreate(username=user_input.username, display_name=user_input.display_name)
+        except ValueError as e:
+            raise _error(INVALID_INPUT, f"Invalid user data: {e}")
+        existing_user = await crud.get_user_by_username(db, username=user_create.username)
         if existing_user:
-            raise StrawberryException(f"Username '{user_input.username}' is already taken.")
-        user = await crud.create_user(db=db, user=user_input)
-        return UserType.from_pydantic(user)
+            raise _error(USERNAME_TAKEN, f"Username '{user_create.username}' is already taken.")
+        user = await crud.create_user(db=db, user=user_create)
+        return user
 
     @strawberry.mutation
     async def verify_registration(self, info: Context, verification_input: RegistrationVerificationInput) -> bool:
@@ -211,43 +257,46 @@ class Mutation:
 
         user = await crud.get_user_by_username(db, username=username)
         if not user:
-            raise StrawberryException(f"User '{username}' not found.")
+            raise _error(USER_NOT_FOUND, f"User '{username}' not found.")
 
         # 保存したチャレンジを取得
-        challenge_b64 = await auth.get_challenge(challenge_key)
-        if not challenge_b64:
-            raise StrawberryException("Registration challenge expired or not found. Please try registering again.")
+        challenge = await auth.get_challenge(challenge_key)
+        if not challenge:
+            raise _error(CHALLENGE_EXPIRED, "Registration challenge expired or not found. Please try registering again.")
 
-        # フロントエンドからの JSON 文字列をパース
+        # フロントエンドからの JSON 文字列をパース (解析と検証を msgspec の Decoder で一度に行う)
         try:
-            reg_response_dict = json.loads(verification_input.registration_response_json)
-            registration_response = schemas.RegistrationResponseJSON(**reg_response_dict)
-        except (json.JSONDecodeError, ValueError) as e:
-            raise StrawberryException(f"Invalid registration response format: {e}")
+            registration_response = schemas.registration_response_decoder.decode(
+                verification_input.registration_response_json
+            )
+        except msgspec.DecodeError as e:
+            raise _error(INVALID_FORMAT, f"Invalid registration response format: {e}")
 
         try:
-            attested_credential_data = await auth.verify_registration(
+            auth_data = await auth.verify_registration(
                 user=user,
                 registration_response=registration_response,
-                expected_challenge_b64=challenge_b64,
+                expected_challenge=challenge,
             )
 
-            # 新しいクレデンシャルをDBに保存
+            # 新しいクレデンシャルをDBに保存 (公開鍵は COSE 鍵を CBOR エンコードしたもの)
             await crud.add_credential_to_user(
                 db=db,
                 user=user,
                 credential_id_b64=registration_response.id, # registration_response.id is already Base64URL string
-                public_key_b64=base64.urlsafe_b64encode(attested_credential_data.credential_public_key).rstrip(b'=').decode('utf-8'),
-                sign_count=attested_credential_data.sign_count,
-                transports=registration_response.response.get("transports") # Optional transports
+                public_key_b64=b64url_encode_nopad(cbor.encode(auth_data.credential_data.public_key)),
+                sign_count=auth_data.counter,
+                transports=registration_response.response.transports # Optional transports
             )
+            # キャッシュ済みのユーザーが古いクレデンシャルを保持しないよう破棄
+            auth.invalidate_user_cache()
             return True
         except HTTPException as e:
-             raise StrawberryException(e.detail)
+             raise _error(VERIFICATION_FAILED, e.detail)
         except Exception as e:
              # Log unexpected errors
              print(f"Unexpected error verifying registration: {e}") # Replace with proper logging
-             raise StrawberryException("An unexpected error occurred during registration verification.")
+             raise _error(INTERNAL_ERROR, "An unexpected error occurred during registration verification.")
 
 
     @strawberry.mutation
@@ -257,57 +306,56 @@ class Mutation:
         challenge_key = verification_input.challenge_key
 
         # 保存したチャレンジを取得
-        challenge_b64 = await auth.get_challenge(challenge_key)
-        if not challenge_b64:
-            raise StrawberryException("Authentication challenge expired or not found. Please try logging in again.")
+        challenge = await auth.get_challenge(challenge_key)
+        if not challenge:
+            raise _error(CHALLENGE_EXPIRED, "Authentication challenge expired or not found. Please try logging in again.")
 
-        # フロントエンドからの JSON 文字列をパース
+        # フロントエンドからの JSON 文字列をパース (解析と検証を msgspec の Decoder で一度に行う)
         try:
-            auth_response_dict = json.loads(verification_input.authentication_response_json)
-            authentication_response = schemas.AuthenticationResponseJSON(**auth_response_dict)
-        except (json.JSONDecodeError, ValueError) as e:
-            raise StrawberryException(f"Invalid authentication response format: {e}")
+            authentication_response = schemas.authentication_response_decoder.decode(
+                verification_input.authentication_response_json
+            )
+        except msgspec.DecodeError as e:
+            raise _error(INVALID_FORMAT, f"Invalid authentication response format: {e}")
 
         try:
             verified_credential = await auth.verify_authentication(
                 credential_id_b64=credential_id_b64,
                 auth_response=authentication_response,
-                expected_challenge_b64=challenge_b64,
+                expected_challenge=challenge,
                 db=db
             )
 
             # 認証成功、JWT を生成
-            access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
-            access_token = auth.create_access_token(
-                data={"sub": verified_credential.user.username}, expires_delta=access_token_expires
-            )
+            # 有効期限は既定の ACCESS_TOKEN_EXPIRE_MINUTES
+            access_token = auth.create_access_token(data={"sub": verified_credential.user.username})
             return TokenType(access_token=access_token, token_type="bearer")
 
         except HTTPException as e:
-            raise StrawberryException(e.detail)
+            raise _error(VERIFICATION_FAILED, e.detail)
         except Exception as e:
              print(f"Unexpected error verifying authentication: {e}") # Replace with proper logging
-             raise StrawberryException("An unexpected error occurred during authentication verification.")
+             raise _error(INTERNAL_ERROR, "An unexpected error occurred during authentication verification.")
 
 
     # --- Item Mutations (Protected) ---
     @strawberry.mutation(permission_classes=[IsAuthenticated])
     async def add_item(self, info: Context, item: ItemInput) -> ItemType:
         db = info.context.db
-        # item_create_schema = schemas.ItemCreate(**item.__dict__) # This might not work well with Strawberry inputs
-        item_create_schema = schemas.ItemCreate(name=item.name, description=item.description, price=item.price)
+        # 値は GraphQL の型 (String / Float) で検証済みなので、Pydantic の検証をもう一度走らせずに組み立てる
+        item_create_schema = schemas.ItemCreate.model_construct(name=item.name, description=item.description, price=item.price)
         created_item = await crud.create_item(db=db, item=item_create_schema)
-        return ItemType.from_pydantic(created_item)
+        return created_item
 
     @strawberry.mutation(permission_classes=[IsAuthenticated])
     async def update_item(self, info: Context, item_id: int, item: ItemInput) -> Optional[ItemType]:
         db = info.context.db
-        # item_update_schema = schemas.ItemCreate(**item.__dict__)
-        item_update_schema = schemas.ItemCreate(name=item.name, description=item.description, price=item.price)
+        # add_item と同様に検証を省く (3 フィールドとも明示的に指定したものとして扱われる)
+        item_update_schema = schemas.ItemCreate.model_construct(name=item.name, description=item.description, price=item.price)
         updated_item = await crud.update_item(db=db, item_id=item_id, item_update=item_update_schema)
         if updated_item is None:
              return None
-        return ItemType.from_pydantic(updated_item)
+        return updated_item
 
     @strawberry.mutation(permission_classes=[IsAuthenticated])
     async def delete_item(self, info: Context, item_id: int) -> bool:
@@ -317,11 +365,56 @@ class Mutation:
 
 
 
+def _orjson_default(obj: Any) -> Any:
+    # WebAuthn オプションの構造体は camelCase の dict にする (bytes はそのまま残し、下で変換される)
+    if isinstance(obj, msgspec.Struct):
+        return msgspec.to_builtins(obj, builtin_types=(bytes,))
+    # WebAuthn オプションに含まれる bytes はここで一度だけ Base64URL (パディングなし) に変換する
+    if isinstance(obj, bytes):
+        return b64url_encode_nopad(obj)
+    # fido2 のデータオブジェクト (PublicKeyCredentialDescriptor など) は Mapping として書き出す
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class ORJSONGraphQLRouter(GraphQLRouter):
+    """GraphQLRouter that serializes responses with orjson."""
+
+    def encode_json(self, data: object) -> str:
+        return orjson.dumps(data, default=_orjson_default).decode("utf-8")
+
+
+GRAPHQL_DOCUMENT_CACHE_SIZE = 256
+
+# 解決済みの値がこれらの型なら await できないことが分かっているので、isawaitable の判定を省く
+_NEVER_AWAITABLE_TYPES = frozenset({int, float, str, bool, type(None), list, dict, bytes})
+
+
+def _is_awaitable(value: Any) -> bool:
+    # graphql-core は解決したフィールドの値 (リストなら要素ごと) に対して毎回呼ぶ
+    if type(value) in _NEVER_AWAITABLE_TYPES:
+        return False
+    return default_is_awaitable(value)
+
+
+class FastAwaitableExecutionContext(ExecutionContext):
+    """ExecutionContext that skips the awaitable check for plain values."""
+
+    is_awaitable = staticmethod(_is_awaitable)
+
+
 # Schema を Query と Mutation で初期化
-schema = strawberry.Schema(query=Query, mutation=Mutation) # Mutation クラスを渡す
+schema = strawberry.Schema(
+    query=Query,
+    mutation=Mutation, # Mutation クラスを渡す
+    execution_context_class=FastAwaitableExecutionContext,
+    # クライアントが送るクエリ文字列は限られているので、パース結果と検証結果をクエリ文字列ごとに LRU で再利用する
+    extensions=[ParserCache(maxsize=GRAPHQL_DOCUMENT_CACHE_SIZE), ValidationCache(maxsize=GRAPHQL_DOCUMENT_CACHE_SIZE)],
+)
 
 # GraphQL ルーターを更新されたコンテキストゲッターで設定
-graphql_app = GraphQLRouter(
+graphql_app = ORJSONGraphQLRouter(
     schema,
     context_getter=get_graphql_context, # 更新された context_getter を使用
     graphiql=True,
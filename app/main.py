@@ -1,7 +1,10 @@
 from fastapi import FastAPI # Remove Depends, HTTPException
+from fastapi.responses import ORJSONResponse
 # Remove typing imports if no longer needed by REST endpoints
 from sqlalchemy.ext.asyncio import AsyncSession
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os # Add os
 from dotenv import load_dotenv # Add dotenv
 
@@ -20,20 +23,30 @@ async def lifespan(app: FastAPI):
     # .env から DB リセット設定を読み込む
     reset_db = os.getenv("RESET_DB_ON_STARTUP", "False").lower() == "true"
 
-    async with engine.begin() as conn:
-      if reset_db:
-          print("RESET_DB_ON_STARTUP is True. Dropping and recreating tables...")
-          # すべてのテーブルを削除 (User, Credential テーブルも含む)
-          await conn.run_sync(Base.metadata.drop_all)
-      else:
-          print("RESET_DB_ON_STARTUP is False. Skipping drop_all.")
-
-      # DBのテーブルを作成 (存在しないテーブルのみ作成される)
-      await conn.run_sync(Base.metadata.create_all)
-      yield
+    # WebAuthn の署名検証 (asyncio.to_thread) が使うデフォルトのスレッドプール
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+    )
+
+    # テーブル作成は開発用。スキーマを別途管理する本番では RUN_MIGRATIONS=false で起動時の DDL を省く
+    run_migrations = os.getenv("RUN_MIGRATIONS", "true").lower() == "true"
+
+    if reset_db or run_migrations:
+        # DDL のトランザクションは起動処理の間だけ保持し、アプリの実行中は接続を返しておく
+        async with engine.begin() as conn:
+            if reset_db:
+                print("RESET_DB_ON_STARTUP is True. Dropping and recreating tables...")
+                # すべてのテーブルを削除 (User, Credential テーブルも含む)
+                await conn.run_sync(Base.metadata.drop_all)
+            else:
+                print("RESET_DB_ON_STARTUP is False. Skipping drop_all.")
+
+            # DBのテーブルを作成 (存在しないテーブルのみ作成される)
+            await conn.run_sync(Base.metadata.create_all)
+    yield
     # Shutdown イベントがあればここに記述
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS 設定 (一時的にすべて許可してデバッグ)
 origins = ["*"] # Allow all origins for debugging
@@ -1,8 +1,11 @@
-from sqlalchemy import String, Float, Integer, ForeignKey, LargeBinary, JSON
+from sqlalchemy import String, Float, Integer, ForeignKey, LargeBinary, JSON, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import Optional, List
 from .database import Base
 
+# WebAuthn の user handle 長 (ランダム 16 バイト)
+USER_HANDLE_BYTES = 16
+
 
 class Item(Base):
     __tablename__ = "items"
@@ -19,8 +22,11 @@ class User(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     username: Mapped[str] = mapped_column(String(50), unique=True, index=True, nullable=False)
     display_name: Mapped[str] = mapped_column(String(100), nullable=False)
+    # WebAuthn の user.id として使うランダムな user handle (DB の主キーを外部に出さない)
+    user_handle: Mapped[bytes] = mapped_column(LargeBinary(USER_HANDLE_BYTES), unique=True, index=True, nullable=False)
 
-    credentials: Mapped[List["Credential"]] = relationship("Credential", back_populates="user")
+    # 非同期セッションでの暗黙の遅延ロードは禁止し、必要な箇所で selectinload する
+    credentials: Mapped[List["Credential"]] = relationship("Credential", back_populates="user", lazy="raise")
 
 
 class Credential(Base):
@@ -34,3 +40,8 @@ class Credential(Base):
     transports: Mapped[Optional[List[str]]] = mapped_column(JSON, nullable=True) # e.g. ["internal", "usb", "nfc", "ble"]
 
     user: Mapped["User"] = relationship("User", back_populates="credentials")
+
+    __table_args__ = (
+        # Postgres では credential_id の等価検索にハッシュインデックスを使う (他の DB では unique インデックスで十分)
+        Index("ix_credentials_credential_id_hash", "credential_id", postgresql_using="hash").ddl_if(dialect="postgresql"),
+    )
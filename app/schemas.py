@@ -1,27 +1,25 @@
-from pydantic import BaseModel, ConfigDict, Field
-from typing import Optional, List, Dict, Any
-import base64
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field
+from typing import Annotated, Optional, List, Dict, Any
+import re
+import msgspec
 
 
 # --- Base64URL encoded string type for better validation ---
-class Base64UrlStr(str):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
-
-    @classmethod
-    def validate(cls, v):
-        if not isinstance(v, str):
-            raise TypeError('string required')
-        try:
-            # Attempt to decode to check if it's valid Base64URL
-            base64.urlsafe_b64decode(v + '==') # Add padding for validation if needed
-        except Exception:
-            raise ValueError('invalid base64url encoding')
-        return cls(v)
-
-    def __repr__(self):
-        return f'Base64UrlStr({super().__repr__()})'
+# デコードせずに文字種と長さだけを検査する (パターンは import 時に一度だけコンパイルする)。
+# msgspec は re.search で照合するので、末尾の改行を許す $ ではなく \Z で終端を固定する
+_BASE64URL_PATTERN = r"^[A-Za-z0-9_-]*(={0,2})\Z"
+_BASE64URL_MATCH = re.compile(_BASE64URL_PATTERN).fullmatch
+
+
+def _validate_base64url(v: str) -> str:
+    m = _BASE64URL_MATCH(v)
+    # パディングなしでは長さ % 4 == 1 になり得ない。パディング付きなら長さは 4 の倍数
+    if m is None or (len(v) & 3 == 1 if not m.group(1) else len(v) & 3):
+        raise ValueError('invalid base64url encoding')
+    return v
+
+
+Base64UrlStr = Annotated[str, AfterValidator(_validate_base64url)]
 
 
 # --- Item Schemas ---
@@ -76,26 +74,100 @@ class CredentialRead(CredentialBase):
 # --- Passkey/WebAuthn Schemas ---
 # Based on @simplewebauthn/typescript-types
 
-class RegistrationResponseJSON(BaseModel):
-    id: Base64UrlStr
-    raw_id: Base64UrlStr = Field(..., alias="rawId")
-    response: Dict[str, Any] # Contains attestationObject and clientDataJSON
+# フロントエンドから届く JSON を msgspec.json.decode で解析と検証を一度に行うための構造体。
+# rename="camel" で rawId などのキー名に対応し、未知のキーは無視する。
+# 文字種はパターンで検証する。長さの規則はパターンで表せないので、DB に保存する id / rawId だけ
+# __post_init__ で _validate_base64url にかける (ValueError は msgspec.ValidationError になる)
+Base64UrlField = Annotated[str, msgspec.Meta(pattern=_BASE64URL_PATTERN)]
+
+
+class AuthenticatorAttestationResponseJSON(msgspec.Struct, rename="camel"):
+    client_data_json: Base64UrlField = msgspec.field(name="clientDataJSON")
+    attestation_object: Base64UrlField
+    transports: Optional[List[str]] = None
+
+
+class AuthenticatorAssertionResponseJSON(msgspec.Struct, rename="camel"):
+    client_data_json: Base64UrlField = msgspec.field(name="clientDataJSON")
+    authenticator_data: Base64UrlField
+    signature: Base64UrlField
+    user_handle: Optional[Base64UrlField] = None
+
+
+class RegistrationResponseJSON(msgspec.Struct, rename="camel"):
+    id: Base64UrlField
+    raw_id: Base64UrlField
+    response: AuthenticatorAttestationResponseJSON
     type: str
-    client_extension_results: Dict[str, Any] = Field(..., alias="clientExtensionResults")
-    authenticator_attachment: Optional[str] = Field(None, alias="authenticatorAttachment")
+    client_extension_results: Dict[str, Any]
+    authenticator_attachment: Optional[str] = None
 
-    model_config = ConfigDict(populate_by_name=True)
+    def __post_init__(self):
+        _validate_base64url(self.id)
+        _validate_base64url(self.raw_id)
 
 
-class AuthenticationResponseJSON(BaseModel):
-    id: Base64UrlStr
-    raw_id: Base64UrlStr = Field(..., alias="rawId")
-    response: Dict[str, Any] # Contains authenticatorData, clientDataJSON, signature, userHandle
+class AuthenticationResponseJSON(msgspec.Struct, rename="camel"):
+    id: Base64UrlField
+    raw_id: Base64UrlField
+    response: AuthenticatorAssertionResponseJSON
     type: str
-    client_extension_results: Dict[str, Any] = Field(..., alias="clientExtensionResults")
-    authenticator_attachment: Optional[str] = Field(None, alias="authenticatorAttachment")
+    client_extension_results: Dict[str, Any]
+    authenticator_attachment: Optional[str] = None
+
+    def __post_init__(self):
+        _validate_base64url(self.id)
+        _validate_base64url(self.raw_id)
+
+
+# 型情報の解析は Decoder の生成時に済むので、import 時に作っておき最初のリクエストで行わない
+registration_response_decoder = msgspec.json.Decoder(RegistrationResponseJSON)
+authentication_response_decoder = msgspec.json.Decoder(AuthenticationResponseJSON)
+
+
+# --- Passkey/WebAuthn options returned to the frontend ---
+# レスポンス専用の構造体。msgspec.Struct は slots を持つ C 実装なので dict より軽く、
+# rename="camel" でフロントエンドが期待するキー名になる。bytes はレスポンスの JSON エンコード時に
+# Base64URL に変換される。pubKeyCredParams などには fido2 のデータオブジェクトをそのまま入れる。
+
+class RpEntityOptions(msgspec.Struct):
+    id: Optional[str]
+    name: str
+
+
+class UserEntityOptions(msgspec.Struct, rename="camel"):
+    id: bytes
+    name: Optional[str]
+    display_name: Optional[str]
+
+
+class AuthenticatorSelectionOptions(msgspec.Struct, rename="camel"):
+    authenticator_attachment: Optional[str]
+    resident_key: Optional[str]
+    user_verification: Optional[str]
+    require_resident_key: Optional[bool]
+
+
+class RegistrationOptions(msgspec.Struct, rename="camel"):
+    rp: RpEntityOptions
+    user: UserEntityOptions
+    challenge: bytes
+    pub_key_cred_params: List[Any]
+    timeout: Optional[int]
+    exclude_credentials: List[Any]
+    authenticator_selection: Optional[AuthenticatorSelectionOptions]
+    attestation: Optional[str]
+    extensions: Optional[Dict[str, Any]]
+
+
+class AuthenticationOptions(msgspec.Struct, rename="camel"):
+    challenge: bytes
+    timeout: Optional[int]
+    rp_id: Optional[str]
+    allow_credentials: List[Any]
+    user_verification: Optional[str]
+    extensions: Optional[Dict[str, Any]]
 
-    model_config = ConfigDict(populate_by_name=True)
 
 # Schema for JWT token response
 class Token(BaseModel):
@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import database
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # テストごとに一時ディレクトリの SQLite を使う (テーブルはまだ作らない)
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    yield engine
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def session_factory(engine):
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(database.Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    return async_sessionmaker(engine, expire_on_commit=False)
@@ -0,0 +1,84 @@
+import time
+from datetime import timedelta
+
+import jwt
+import pytest
+
+from app import auth
+
+
+def _pyjwt_token(payload: dict) -> str:
+    return jwt.encode(payload, auth.SECRET_KEY, algorithm="HS256")
+
+
+def test_fast_path_token_is_accepted_by_pyjwt():
+    token = auth.create_access_token({"sub": "alice"})
+    payload = jwt.decode(token, auth.SECRET_KEY, algorithms=["HS256"])
+    assert payload["sub"] == "alice"
+    assert auth._decode_token(token) == payload
+    assert isinstance(payload["exp"], int)
+    assert payload["exp"] - int(time.time()) in range(auth.ACCESS_TOKEN_EXPIRE_MINUTES * 60 - 1, auth.ACCESS_TOKEN_EXPIRE_MINUTES * 60 + 1)
+
+
+def test_pyjwt_token_is_accepted_by_fast_path():
+    exp = int(time.time()) + 60
+    token = _pyjwt_token({"sub": "bob", "exp": exp})
+    # ヘッダーが一致するので高速パスで検証される
+    assert token.split(".")[0].encode() == auth._HS256_HEADER_B64
+    assert auth._decode_token(token) == {"sub": "bob", "exp": exp}
+
+
+def test_bad_signature_is_rejected():
+    token = auth.create_access_token({"sub": "alice"})
+    header, payload, _ = token.split(".")
+    forged = f"{header}.{payload}.{auth.create_access_token({'sub': 'mallory'}).split('.')[2]}"
+    with pytest.raises(jwt.InvalidSignatureError):
+        auth._decode_token(forged)
+    with pytest.raises(jwt.InvalidSignatureError):
+        jwt.decode(forged, auth.SECRET_KEY, algorithms=["HS256"])
+
+
+@pytest.mark.parametrize("token", ["", "a.b", "not-a-jwt", "é.a.b"])
+def test_malformed_token_is_rejected(token):
+    with pytest.raises(jwt.DecodeError):
+        auth._decode_token(token)
+
+
+def test_expired_token_is_rejected():
+    token = auth.create_access_token({"sub": "alice"}, expires_delta=timedelta(seconds=-5))
+    with pytest.raises(jwt.ExpiredSignatureError):
+        auth._decode_token(token)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        jwt.decode(token, auth.SECRET_KEY, algorithms=["HS256"])
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"sub": 123, "exp": int(time.time()) + 60},
+        {"sub": "alice", "exp": float(int(time.time()) + 60)},
+        {"sub": "alice", "exp": True},
+        {"sub": "alice", "exp": int(time.time()) + 60, "nbf": int(time.time()) + 100},
+    ],
+)
+def test_unusual_claims_match_pyjwt(payload):
+    # 高速パスの対象外となるクレームは PyJWT と同じ結果になる
+    token = _pyjwt_token(payload)
+    try:
+        expected = jwt.decode(token, auth.SECRET_KEY, algorithms=["HS256"])
+    except jwt.PyJWTError as e:
+        with pytest.raises(type(e)):
+            auth._decode_token(token)
+    else:
+        assert auth._decode_token(token) == expected
+
+
+def test_fido2_server_is_built_once_and_can_be_rebuilt(monkeypatch):
+    server = auth.get_fido2_server()
+    assert auth.get_fido2_server() is server
+    monkeypatch.setattr(auth, "RP_ID", "example.com")
+    auth.get_fido2_server.cache_clear()
+    try:
+        assert auth.get_fido2_server().rp.id == "example.com"
+    finally:
+        auth.get_fido2_server.cache_clear()
@@ -0,0 +1,25 @@
+import base64
+import os
+
+import pytest
+
+from app._b64 import b64url_decode, b64url_encode_nopad
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 16, 31, 32, 33, 64])
+def test_round_trip_matches_stdlib(size):
+    data = os.urandom(size)
+    encoded = b64url_encode_nopad(data)
+    assert encoded == base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+    assert b64url_decode(encoded) == data
+    assert b64url_decode(encoded.encode("ascii")) == data
+
+
+def test_padded_input_is_accepted():
+    data = os.urandom(31)
+    assert b64url_decode(base64.urlsafe_b64encode(data).decode("ascii")) == data
+
+
+def test_invalid_length_raises_value_error():
+    with pytest.raises(ValueError):
+        b64url_decode("abcde")
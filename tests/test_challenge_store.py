@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from app import auth
+
+
+def test_memory_store_is_single_use():
+    store = auth._MemoryChallengeStore(ttl=300)
+
+    async def run():
+        await store.set("k", b"challenge")
+        return await store.getdel("k"), await store.getdel("k")
+
+    assert asyncio.run(run()) == (b"challenge", None)
+
+
+def test_memory_store_expires(monkeypatch):
+    store = auth._MemoryChallengeStore(ttl=300)
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, "monotonic", lambda: now[0])
+
+    async def run():
+        await store.set("k", b"challenge")
+        now[0] += 300
+        return await store.getdel("k")
+
+    assert asyncio.run(run()) is None
+
+
+def test_redis_store_uses_ttl_and_getdel():
+    pytest.importorskip("redis")
+    calls = []
+
+    class FakeRedis:
+        async def set(self, key, value, ex=None):
+            calls.append(("set", key, value, ex))
+
+        async def getdel(self, key):
+            calls.append(("getdel", key))
+            return b"challenge"
+
+    store = auth._RedisChallengeStore("redis://localhost:6379/0", ttl=300)
+    store._redis = FakeRedis()
+
+    async def run():
+        await store.set("k", b"challenge")
+        return await store.getdel("k")
+
+    assert asyncio.run(run()) == b"challenge"
+    assert calls == [("set", "k", b"challenge", 300), ("getdel", "k")]
+
+
+def test_challenge_key_is_opaque_and_deterministic():
+    key = auth.generate_challenge_key("alice", "reg")
+    assert key == auth.generate_challenge_key("alice", "reg")
+    assert len(key) == 32 and "alice" not in key
+    assert key != auth.generate_challenge_key("alice", "auth")
+    assert key != auth.generate_challenge_key("bob", "reg")
+
+
+def test_memory_store_drops_expired_and_oldest_entries(monkeypatch):
+    store = auth._MemoryChallengeStore(ttl=300, maxsize=3)
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, "monotonic", lambda: now[0])
+
+    async def run():
+        await store.set("a", b"1")
+        now[0] += 200
+        await store.set("b", b"2")
+        now[0] += 150
+        # a は期限切れなので、取り出されなくてもここで捨てられる
+        await store.set("c", b"3")
+        await store.set("d", b"4")
+        await store.set("e", b"5")
+        return list(store._data)
+
+    assert asyncio.run(run()) == ["c", "d", "e"]
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+
+from app import crud, schemas
+
+
+@pytest.fixture
+def run_with_db(session_factory):
+    def run(fn):
+        async def main():
+            async with session_factory() as db:
+                return await fn(db)
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_update_item_returns_updated_row(run_with_db):
+    async def fn(db):
+        item = await crud.create_item(db, schemas.ItemCreate(name="a", price=1.0, description="d"))
+        updated = await crud.update_item(db, item.id, schemas.ItemCreate(name="b", price=2.0))
+        missing = await crud.update_item(db, item.id + 1, schemas.ItemCreate(name="c", price=3.0))
+        return item, updated, missing
+
+    item, updated, missing = run_with_db(fn)
+    # 同じセッションで読み込み済みのインスタンスも更新後の値になる
+    assert updated is item
+    assert (updated.name, updated.price, updated.description) == ("b", 2.0, "d")
+    assert missing is None
+
+
+def test_delete_item_reports_whether_a_row_was_deleted(run_with_db):
+    async def fn(db):
+        item = await crud.create_item(db, schemas.ItemCreate(name="a", price=1.0))
+        return await crud.delete_item(db, item.id), await crud.delete_item(db, item.id)
+
+    assert run_with_db(fn) == (True, False)
+
+
+def test_update_credential_sign_count(run_with_db):
+    async def fn(db):
+        user = await crud.create_user(db, schemas.UserCreate(username="alice", display_name="Alice"))
+        credential = await crud.add_credential_to_user(db, user, "AAAA", "AAAA", 0)
+        await crud.update_credential_sign_count(db, credential, 5)
+        dirty = bool(db.dirty)
+        db.expunge_all()
+        stored = await crud.get_credentials_by_user(db, user.id)
+        return credential.sign_count, dirty, stored[0].sign_count
+
+    assert run_with_db(fn) == (5, False, 5)
+
+
+def test_credential_lookups(run_with_db):
+    async def fn(db):
+        user = await crud.create_user(db, schemas.UserCreate(username="alice", display_name="Alice"))
+        await crud.add_credential_to_user(db, user, "AQID", "AAAA", 0)
+        by_id = await crud.get_credential_by_id(db, b"\x01\x02\x03")
+        missing = await crud.get_credential_by_id(db, b"\x04")
+        by_name = await crud.get_user_by_username(db, "alice", with_credentials=True)
+        db.expunge_all()
+        by_pk = await crud.get_user(db, user.id, with_credentials=True)
+        db.expunge_all()
+        without = await crud.get_user_by_username(db, "alice")
+        return user, by_id, missing, by_name, by_pk, without
+
+    user, by_id, missing, by_name, by_pk, without = run_with_db(fn)
+    assert by_id.credential_id == b"\x01\x02\x03"
+    assert by_id.user.username == "alice"
+    assert missing is None
+    assert [c.credential_id for c in by_name.credentials] == [b"\x01\x02\x03"]
+    # credentials は eager load 済みで、セッション外でも参照できる
+    assert [c.credential_id for c in by_pk.credentials] == [b"\x01\x02\x03"]
+    # 既定では credentials を読み込まず、参照すると遅延ロードせずに例外になる
+    with pytest.raises(InvalidRequestError):
+        without.credentials
+
+
+def test_users_get_random_user_handle(run_with_db):
+    async def fn(db):
+        alice = await crud.create_user(db, schemas.UserCreate(username="alice", display_name="Alice"))
+        bob = await crud.create_user(db, schemas.UserCreate(username="bob", display_name="Bob"))
+        found = await crud.get_user_by_handle(db, bob.user_handle)
+        missing = await crud.get_user_by_handle(db, b"\x00" * 16)
+        return alice, bob, found, missing
+
+    alice, bob, found, missing = run_with_db(fn)
+    assert len(alice.user_handle) == 16
+    assert alice.user_handle != bob.user_handle
+    assert found is bob
+    assert missing is None
@@ -0,0 +1,283 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import auth, crud, database, main
+from app._b64 import b64url_decode
+
+
+@pytest.fixture
+def client(engine, monkeypatch):
+    monkeypatch.setattr(main, "engine", engine)
+    monkeypatch.setattr(database, "AsyncSessionLocal", async_sessionmaker(engine, expire_on_commit=False))
+    auth.invalidate_user_cache()
+    with TestClient(main.app) as c:
+        yield c
+    auth.invalidate_user_cache()
+
+
+def gql(client, query, token=None):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    return client.post("/graphql", json={"query": query}, headers=headers).json()
+
+
+def test_registration_options_encode_bytes_as_base64url(client):
+    result = gql(client, '{ generateRegistrationOptions(username: "alice", displayName: "Alice") }')
+    options = result["data"]["generateRegistrationOptions"]["options"]
+    assert len(b64url_decode(options["challenge"])) == 32
+    assert "=" not in options["user"]["id"]
+    assert options["pubKeyCredParams"][0] == {"type": "public-key", "alg": -7}
+
+
+def test_discoverable_authentication_options(client):
+    result = gql(client, "{ generateAuthenticationOptions }")
+    options = result["data"]["generateAuthenticationOptions"]["options"]
+    assert len(b64url_decode(options["challenge"])) == 32
+    assert options["allowCredentials"] == []
+    assert options["userVerification"] == "preferred"
+
+
+def test_me_requires_valid_token(client):
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    token = auth.create_access_token({"sub": "alice"})
+    assert gql(client, "{ me { username } }", token) == {"data": {"me": {"username": "alice"}}}
+    assert gql(client, "{ me { username } }", "bad.token.value")["data"] is None
+
+
+def _add_credential(client, username, credential_id_b64):
+    async def add():
+        async with database.AsyncSessionLocal() as db:
+            user = await crud.get_user_by_username(db, username)
+            await crud.add_credential_to_user(db, user, credential_id_b64, "AAAA", 0)
+
+    client.portal.call(add)
+
+
+def test_options_list_existing_credentials(client):
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    _add_credential(client, "alice", "AQID")
+
+    reg = gql(client, '{ generateRegistrationOptions(username: "alice", displayName: "Alice") }')
+    assert reg["data"]["generateRegistrationOptions"]["options"]["excludeCredentials"] == [
+        {"type": "public-key", "id": "AQID", "transports": None}
+    ]
+    authn = gql(client, '{ generateAuthenticationOptions(username: "alice") }')
+    assert authn["data"]["generateAuthenticationOptions"]["options"]["allowCredentials"] == [
+        {"type": "public-key", "id": "AQID", "transports": None}
+    ]
+
+
+def test_options_use_user_handle(client):
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    _add_credential(client, "alice", "AQID")
+
+    reg = gql(client, '{ generateRegistrationOptions(username: "alice", displayName: "Alice") }')
+    user_handle = reg["data"]["generateRegistrationOptions"]["options"]["user"]["id"]
+    assert len(b64url_decode(user_handle)) == 16
+
+    async def authn():
+        async with database.AsyncSessionLocal() as db:
+            return await auth.generate_authentication_options(user_handle_b64=user_handle, db=db)
+
+    options = client.portal.call(authn)
+    assert [c.id for c in options.allow_credentials] == [b"\x01\x02\x03"]
+
+
+def test_challenge_is_stored_as_raw_bytes(client):
+    result = gql(client, '{ generateAuthenticationOptions }')
+    payload = result["data"]["generateAuthenticationOptions"]
+    stored = client.portal.call(auth.get_challenge, payload["challengeKey"])
+    assert stored == b64url_decode(payload["options"]["challenge"])
+
+
+def test_current_user_is_resolved_lazily_and_once(client, monkeypatch):
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    token = auth.create_access_token({"sub": "alice"})
+    calls = []
+    original = auth.get_current_user
+
+    async def spy(token, db):
+        calls.append(token)
+        return await original(token=token, db=db)
+
+    monkeypatch.setattr(auth, "get_current_user", spy)
+    assert gql(client, "{ generateAuthenticationOptions }", token)["data"] is not None
+    assert calls == []
+    result = gql(client, "{ me { username } items { id } }", token)
+    assert result == {"data": {"me": {"username": "alice"}, "items": []}}
+    assert calls == [token]
+
+
+def test_item_mutations_and_queries_return_orm_rows(client):
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    token = auth.create_access_token({"sub": "alice"})
+    added = gql(client, 'mutation { addItem(item: {name: "pen", price: 1.5}) { id name description price } }', token)
+    item = added["data"]["addItem"]
+    assert item == {"id": item["id"], "name": "pen", "description": None, "price": 1.5}
+    updated = gql(client, f'mutation {{ updateItem(itemId: {item["id"]}, item: {{name: "pen", price: 2.0}}) {{ price }} }}', token)
+    assert updated == {"data": {"updateItem": {"price": 2.0}}}
+    listed = gql(client, "{ items { name price } }", token)
+    assert listed == {"data": {"items": [{"name": "pen", "price": 2.0}]}}
+    me = gql(client, "{ me { id username displayName } }", token)
+    assert me["data"]["me"]["displayName"] == "Alice"
+
+
+def test_is_awaitable_shortcut_matches_graphql_core():
+    from graphql.pyutils import is_awaitable
+
+    from app import graphql_schema
+
+    async def coro():
+        pass
+
+    c = coro()
+    for value in (1, 1.5, "s", True, None, [], {}, b"", object(), c):
+        assert graphql_schema._is_awaitable(value) is is_awaitable(value)
+    c.close()
+    assert graphql_schema.schema.execution_context_class is graphql_schema.FastAwaitableExecutionContext
+
+
+def test_cached_documents_keep_validation_errors(client):
+    for _ in range(2):
+        result = gql(client, "{ generateAuthenticationOptions(bogus: 1) }")
+        assert result["data"] is None
+        assert "Unknown argument 'bogus'" in result["errors"][0]["message"]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        "not json",
+        '{"id": "AQID", "rawId": "AQID", "response": {}, "type": "public-key"}',
+        '{"id": "a+b", "rawId": "AQID", "response": {}, "type": "public-key", "clientExtensionResults": {}}',
+    ],
+)
+def test_invalid_authentication_response_is_rejected(client, payload):
+    key = gql(client, "{ generateAuthenticationOptions }")["data"]["generateAuthenticationOptions"]["challengeKey"]
+    query = (
+        "mutation($json: String!, $key: String!) { verifyAuthentication(verificationInput: "
+        "{credentialIdB64: \"AQID\", authenticationResponseJson: $json, challengeKey: $key}) { accessToken } }"
+    )
+    result = client.post("/graphql", json={"query": query, "variables": {"json": payload, "key": key}}).json()
+    assert result["errors"][0]["message"].startswith("Invalid authentication response format")
+    assert result["errors"][0]["extensions"] == {"code": "INVALID_FORMAT"}
+
+
+
+def test_startup_skips_ddl_when_migrations_are_disabled(engine, monkeypatch):
+    from sqlalchemy import inspect
+
+    monkeypatch.setattr(main, "engine", engine)
+    monkeypatch.setenv("RUN_MIGRATIONS", "false")
+
+    async def table_names():
+        async with engine.connect() as conn:
+            return await conn.run_sync(lambda c: inspect(c).get_table_names())
+
+    with TestClient(main.app) as c:
+        assert c.portal.call(table_names) == []
+
+
+def test_expired_challenge_error_has_code(client):
+    query = (
+        'mutation { verifyAuthentication(verificationInput: '
+        '{credentialIdB64: "AQID", authenticationResponseJson: "{}", challengeKey: "missing"}) { accessToken } }'
+    )
+    error = gql(client, query)["errors"][0]
+    assert error["extensions"] == {"code": "CHALLENGE_EXPIRED"}
+    assert error["message"].startswith("Authentication challenge expired")
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ([], None),
+        ([(b"authorization", b"Bearer abc.def")], "abc.def"),
+        ([(b"authorization", b"bearer   abc.def ")], "abc.def"),
+        ([(b"authorization", b"Basic abc")], None),
+        ([(b"authorization", b"Bearer a b")], None),
+        ([(b"authorization", b"Bearer ")], None),
+        ([(b"x-other", b"1"), (b"authorization", b"Bearer t")], "t"),
+    ],
+)
+def test_get_bearer_token(headers, expected):
+    from starlette.requests import Request
+
+    from app.graphql_schema import get_bearer_token
+
+    assert get_bearer_token(Request({"type": "http", "headers": headers})) == expected
+
+
+def _sign_in(client, private_key, counter, challenge=None):
+    import hashlib
+    import json
+
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    from app._b64 import b64url_encode_nopad
+
+    payload = gql(client, '{ generateAuthenticationOptions(username: "alice") }')["data"]["generateAuthenticationOptions"]
+    client_data = json.dumps(
+        {"type": "webauthn.get", "challenge": challenge or payload["options"]["challenge"], "origin": auth.RP_ORIGIN}
+    ).encode()
+    auth_data = hashlib.sha256(auth.RP_ID.encode()).digest() + b"\x01" + counter.to_bytes(4, "big")
+    signature = private_key.sign(auth_data + hashlib.sha256(client_data).digest(), ec.ECDSA(hashes.SHA256()))
+    response = {
+        "id": "AQID",
+        "rawId": "AQID",
+        "type": "public-key",
+        "clientExtensionResults": {},
+        "response": {
+            "clientDataJSON": b64url_encode_nopad(client_data),
+            "authenticatorData": b64url_encode_nopad(auth_data),
+            "signature": b64url_encode_nopad(signature),
+        },
+    }
+    query = (
+        "mutation($json: String!, $key: String!) { verifyAuthentication(verificationInput: "
+        "{credentialIdB64: \"AQID\", authenticationResponseJson: $json, challengeKey: $key}) { accessToken } }"
+    )
+    variables = {"json": json.dumps(response), "key": payload["challengeKey"]}
+    return client.post("/graphql", json={"query": query, "variables": variables}).json()
+
+
+def test_passkey_sign_in_verifies_signature_and_counter(client):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from fido2 import cbor
+    from fido2.cose import ES256
+
+    from app._b64 import b64url_encode_nopad
+
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_key = b64url_encode_nopad(cbor.encode(ES256.from_cryptography_key(private_key.public_key())))
+    gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+
+    async def add():
+        async with database.AsyncSessionLocal() as db:
+            user = await crud.get_user_by_username(db, "alice")
+            await crud.add_credential_to_user(db, user, "AQID", public_key, 0)
+
+    client.portal.call(add)
+
+    token = _sign_in(client, private_key, counter=1)["data"]["verifyAuthentication"]["accessToken"]
+    assert gql(client, "{ me { username } }", token) == {"data": {"me": {"username": "alice"}}}
+    # カウンターが進んでいない応答はリプレイとして拒否する
+    replay = _sign_in(client, private_key, counter=1)["errors"][0]
+    assert (replay["extensions"]["code"], "replay" in replay["message"]) == ("VERIFICATION_FAILED", True)
+    # 別の鍵の署名は拒否する
+    forged = _sign_in(client, ec.generate_private_key(ec.SECP256R1()), counter=2)["errors"][0]
+    assert "Invalid signature" in forged["message"]
+    # 発行したものと異なるチャレンジへの署名は拒否する
+    stale = _sign_in(client, private_key, counter=2, challenge="A" * 43)["errors"][0]
+    assert "Wrong challenge" in stale["message"]
+    assert _sign_in(client, private_key, counter=2)["data"]["verifyAuthentication"]["accessToken"]
+
+
+def test_register_user_validates_input(client):
+    result = gql(client, 'mutation { registerUser(userInput: {username: "al", displayName: "Al"}) { id } }')
+    assert result["errors"][0]["extensions"] == {"code": "INVALID_INPUT"}
+    ok = gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { username } }')
+    assert ok == {"data": {"registerUser": {"username": "alice"}}}
+    taken = gql(client, 'mutation { registerUser(userInput: {username: "alice", displayName: "Alice"}) { id } }')
+    assert taken["errors"][0]["extensions"] == {"code": "USERNAME_TAKEN"}
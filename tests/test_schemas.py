@@ -0,0 +1,58 @@
+import base64
+import os
+
+import msgspec
+import pytest
+from pydantic import TypeAdapter, ValidationError
+
+from app import schemas
+
+_adapter = TypeAdapter(schemas.Base64UrlStr)
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 16, 32])
+def test_base64url_accepts_padded_and_unpadded(size):
+    encoded = base64.urlsafe_b64encode(os.urandom(size)).decode("ascii")
+    assert _adapter.validate_python(encoded) == encoded
+    assert _adapter.validate_python(encoded.rstrip("=")) == encoded.rstrip("=")
+
+
+@pytest.mark.parametrize("value", ["abcde", "ab+/", "ab=", "a===", "ab==cd", "é", 123])
+def test_base64url_rejects_invalid(value):
+    with pytest.raises(ValidationError):
+        _adapter.validate_python(value)
+
+
+def test_authentication_response_is_decoded_into_struct():
+    payload = (
+        b'{"id": "AQID", "rawId": "AQID", "type": "public-key", "clientExtensionResults": {}, "extra": 1,'
+        b' "response": {"clientDataJSON": "e30", "authenticatorData": "AA", "signature": "AQ"}}'
+    )
+    decoded = msgspec.json.decode(payload, type=schemas.AuthenticationResponseJSON)
+    assert (decoded.raw_id, decoded.authenticator_attachment) == ("AQID", None)
+    assert decoded.response == schemas.AuthenticatorAssertionResponseJSON(
+        client_data_json="e30", authenticator_data="AA", signature="AQ"
+    )
+
+
+def test_registration_response_requires_typed_fields():
+    payload = b'{"id": "AQID", "rawId": "AQID", "type": "public-key", "clientExtensionResults": {}, "response": %s}'
+    decoded = msgspec.json.decode(
+        payload % b'{"clientDataJSON": "e30", "attestationObject": "oA", "transports": ["usb"]}',
+        type=schemas.RegistrationResponseJSON,
+    )
+    assert decoded.response.transports == ["usb"]
+    with pytest.raises(msgspec.ValidationError):
+        msgspec.json.decode(payload % b'{"clientDataJSON": "e30"}', type=schemas.RegistrationResponseJSON)
+
+
+@pytest.mark.parametrize("raw_id", ["A", "AQIDB", "AQID\\n", "AQ=\\n"])
+def test_response_ids_follow_base64url_length_rule(raw_id):
+    payload = (
+        b'{"id": "%s", "rawId": "%s", "type": "public-key", "clientExtensionResults": {},'
+        b' "response": {"clientDataJSON": "e30", "authenticatorData": "AA", "signature": "AQ"}}'
+    ) % (raw_id.encode(), raw_id.encode())
+    with pytest.raises(msgspec.ValidationError):
+        schemas.authentication_response_decoder.decode(payload)
+    with pytest.raises(ValidationError):
+        _adapter.validate_python(msgspec.json.decode(b'"%s"' % raw_id.encode()))
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import jwt
+import pytest
+
+from app import auth, crud, schemas
+
+
+@pytest.fixture
+def session_factory(session_factory):
+    async def setup():
+        async with session_factory() as db:
+            await crud.create_user(db, schemas.UserCreate(username="alice", display_name="A"))
+
+    asyncio.run(setup())
+    auth.invalidate_user_cache()
+    yield session_factory
+    auth.invalidate_user_cache()
+
+
+def test_cached_user_is_session_bound_copy(session_factory):
+    token = auth.create_access_token({"sub": "alice"})
+
+    async def run():
+        async with session_factory() as db:
+            first = await auth.get_current_user(token, db)
+        async with session_factory() as db:
+            second = await auth.get_current_user(token, db)
+            assert second is not first
+            assert second in db
+            second.display_name = "B"
+            await db.commit()
+        async with session_factory() as db:
+            stored = await crud.get_user_by_username(db, "alice")
+        return first, stored
+
+    first, stored = asyncio.run(run())
+    # 変更は DB に反映され、キャッシュ内のスナップショットは書き換わらない
+    assert stored.display_name == "B"
+    assert first.display_name == "A"
+
+
+def test_invalidate_frees_entries(session_factory):
+    token = auth.create_access_token({"sub": "alice"})
+
+    async def run():
+        async with session_factory() as db:
+            await auth.get_current_user(token, db)
+
+    asyncio.run(run())
+    assert len(auth._user_cache) == 1
+    auth.invalidate_user_cache()
+    assert len(auth._user_cache) == 0
+
+
+def test_string_exp_from_pyjwt_path_is_accepted(session_factory):
+    # PyJWT は数値文字列の exp を受け付けるので、TTL 計算で 500 にならないこと
+    token = jwt.encode({"sub": "alice", "exp": str(int(time.time()) + 60)}, auth.SECRET_KEY, algorithm="HS256")
+
+    async def run():
+        async with session_factory() as db:
+            return await auth.get_current_user(token, db)
+
+    assert asyncio.run(run()).username == "alice"